@@ -31,11 +31,21 @@
 """
 
 import asyncio
-import json
+import functools
+import ipaddress
+import logging
+import math
 import os
+import re
 import sys
 import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from types import MappingProxyType
+import fastjsonschema
 import ollama
+import orjson
 import httpx
 from mcp import ClientSession
 from mcp.client.sse import sse_client
@@ -57,9 +67,152 @@ OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
 # and fits comfortably in a T4's 16GB VRAM
 MODEL = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
 
+# How long Ollama keeps the model loaded in GPU memory after a request.
+# Without this the model can be evicted between queries, and the next
+# chat call stalls for several seconds while it reloads.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "1h")
+
+# Context window (in tokens) requested from Ollama. Set explicitly so it
+# never changes between calls - a different value would force Ollama to
+# reload the model and throw away its prompt cache.
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "8192"))
+
 # How many times should the agent loop before we force-stop it?
 # This is a safety guard - without it, a confused agent could loop forever
 MAX_ITERATIONS = int(os.getenv("MAX_ITERATIONS", "10"))
+MAX_ITERATIONS_MESSAGE = "Agent reached maximum iterations without completing analysis."
+
+# How many MCP tool calls may be in flight at the same time?
+# Tool calls run in parallel, so a confused LLM turn asking for dozens
+# of lookups could hammer the backends. This caps it.
+# (The Ollama server has its own knob, OLLAMA_NUM_PARALLEL, for how many
+#  chat requests it decodes at once - see docker-compose.yml.)
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", "8"))
+_tool_semaphore = asyncio.Semaphore(TOOL_CONCURRENCY)
+
+# Speculative decoding (off by default). While lookup tools are still
+# running, start the NEXT LLM call with "<pending>" placeholders instead of
+# waiting. If that guess turns out usable, one LLM round-trip is hidden
+# behind the tool calls. Set AGENT_SPECULATIVE=1 to try it.
+AGENT_SPECULATIVE = os.getenv("AGENT_SPECULATIVE", "0") == "1"
+
+# The system prompt tells the LLM to start with get_recent_alerts, so the
+# agent sends that call itself while the LLM is still reading the prompt.
+# If the LLM asks for the same call it gets the prefetched answer; if it
+# asks for something else the prefetch is cancelled. Set to 0 to disable.
+PREFETCH_ALERTS = os.getenv("PREFETCH_ALERTS", "1") == "1"
+PREFETCH_ALERTS_ARGS = {"limit": 5}
+
+# How the agent investigates:
+#   "react" - the classic agent loop: the LLM asks for a few tools, sees
+#             the results, asks for more... one LLM turn per round.
+#   "plan"  - the LLM first writes a PLAN of every tool call it needs
+#             (a small dependency graph), all of those calls run in
+#             parallel, and then the LLM writes its assessment from the
+#             results. Far fewer LLM turns; falls back to "react" if the
+#             plan can't be used.
+AGENT_MODE = os.getenv("AGENT_MODE", "react")
+
+# Final assessments are cached, so asking the same question again skips the
+# whole agent loop. Exact repeats always hit; if EMBED_MODEL is set (e.g.
+# "nomic-embed-text", pulled into Ollama) REPHRASED questions hit too when
+# their embeddings are at least SEMANTIC_CACHE_THRESHOLD similar.
+# Alerts change over time, so answers expire after ASSESSMENT_CACHE_TTL
+# seconds (0 turns the cache off).
+ASSESSMENT_CACHE_TTL = float(os.getenv("ASSESSMENT_CACHE_TTL", "600"))
+ASSESSMENT_CACHE_SIZE = int(os.getenv("ASSESSMENT_CACHE_SIZE", "256"))
+EMBED_MODEL = os.getenv("EMBED_MODEL", "")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))
+
+# How many MCP sessions the agent keeps open for reuse. Each concurrent
+# query borrows one, so this matches the default run_soc_agent_batch() concurrency.
+MCP_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "4"))
+
+# Pooled sessions older than this (seconds) are closed and replaced with a
+# fresh one the next time they would be handed out.
+MCP_SESSION_MAX_AGE = float(os.getenv("MCP_SESSION_MAX_AGE", "3600"))
+
+# How long (seconds) a discovered tool list is reused before we ask the
+# MCP server again. Tools rarely change while the server is running.
+TOOLS_CACHE_TTL = float(os.getenv("TOOLS_CACHE_TTL", "300"))
+
+# How long (seconds) a tool RESULT is reused for an identical call, and
+# how many results to keep. TOOL_CACHE_TTL=0 turns result caching off.
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", "300"))
+TOOL_CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", "1024"))
+
+# How many of the most recent tool results are kept word-for-word in the
+# conversation. Older ones are shrunk to a short summary, because the whole
+# conversation is re-sent to the LLM every iteration - without this the
+# prompt (and the time the LLM spends reading it) keeps growing.
+MAX_HISTORY_TOOL_MSGS = int(os.getenv("MAX_HISTORY_TOOL_MSGS", "8"))
+
+# Fields removed from JSON tool results before the LLM sees them
+# (comma-separated). Timestamps cost tokens and add nothing to the analysis.
+TOOL_RESULT_DROP_FIELDS = frozenset(
+    f.strip() for f in os.getenv("TOOL_RESULT_DROP_FIELDS", "checked_at,queried_at").split(",") if f.strip()
+)
+
+# How much detail to log. Set LOG_LEVEL=DEBUG to also see the exact
+# arguments of every tool call.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+log = logging.getLogger(__name__)
+
+
+# -------------------------------------------------------
+# THE SYSTEM PROMPT
+# -------------------------------------------------------
+# The "system prompt" defines the agent's role and behavior.
+# This is how you instruct the LLM to act like a SOC analyst.
+# The quality of this prompt significantly affects agent behavior!
+# -------------------------------------------------------
+SYSTEM_PROMPT = """You are a skilled SOC (Security Operations Center) analyst.
+Your job is to investigate security alerts and provide threat assessments.
+
+IMPORTANT: You have tools available. You MUST call them to gather data — do NOT write out JSON or describe tool calls in text. Use the actual tool-calling mechanism provided to you.
+
+Start by calling get_recent_alerts to see current alerts. Then for each external IP address found, call check_ip_reputation and lookup_ip_geolocation to gather threat intelligence. When more than one IP needs geolocating, call lookup_ip_geolocation_batch ONCE with all of them instead of lookup_ip_geolocation for each.
+
+Private IP ranges (10.x.x.x, 192.168.x.x, 172.16-31.x.x) are internal and generally less suspicious than external IPs.
+
+Only after you have gathered all the data using tools, write your final threat assessment with:
+- Summary of findings
+- Risk level (LOW/MEDIUM/HIGH/CRITICAL) for each alert
+- Recommended actions (BLOCK, MONITOR, or INVESTIGATE)
+
+Always reference actual alert IDs and IP addresses in your analysis."""
+
+# Every conversation starts with these messages. A tuple of read-only
+# mappings, so nothing can modify them by accident - not even through the
+# copy of the list each query makes: the system prompt must stay
+# byte-for-byte the same between queries for Ollama to reuse its cached
+# work on it.
+_BASE_MESSAGES = (MappingProxyType({"role": "system", "content": SYSTEM_PROMPT}),)
+
+# Sent when EVERY tool call in a turn repeats one already made: the LLM
+# is going round in circles, so it gets no tools for one last turn.
+FINAL_ANSWER_NUDGE = """Every tool call you just made repeats a call you already made, so no new information is coming.
+Do not call any more tools. Write your final threat assessment now, using the results above."""
+
+# The planner (AGENT_MODE=plan) gets its own prompt: instead of calling
+# tools it must answer with a JSON plan of ALL the calls it wants.
+# The list of available tools is added to the end at run time.
+PLANNER_PROMPT = """You are the planning step of a SOC (Security Operations Center) investigation.
+Do NOT investigate yet. List EVERY tool call the investigation needs, so they can all run at the same time.
+
+Reply with ONLY a JSON object in this exact form:
+{"nodes": [{"id": "n1", "tool": "<tool name>", "args": {"<argument>": "<value>"}, "deps": []}]}
+
+- id: a unique name for the call ("n1", "n2", ...)
+- tool: one of the available tools listed below
+- args: the tool's arguments
+- deps: ids of calls that must finish first (usually empty - lookups for different IPs never depend on each other)
+
+The recent alerts have already been fetched and are included below. For each external IP address in them, plan check_ip_reputation, plus ONE lookup_ip_geolocation_batch call with all of the external IPs. Do not plan lookups for private IP ranges (10.x.x.x, 192.168.x.x, 172.16-31.x.x).
+
+Available tools:
+"""
 
 
 # -------------------------------------------------------
@@ -94,6 +247,64 @@ def convert_mcp_tool_to_ollama_format(mcp_tool) -> dict:
     }
 
 
+# -------------------------------------------------------
+# INTERNAL TOOLS
+# -------------------------------------------------------
+# Some server tools are for the AGENT, not the LLM: they are
+# hidden from the LLM's tool list and never dispatched for it.
+#   get_reputation_index - the full threat-feed IP list, so
+#                          clean IPs skip check_ip_reputation
+# -------------------------------------------------------
+INTERNAL_TOOLS = frozenset({"get_reputation_index"})
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Discover tools (with a cache)
+# -------------------------------------------------------
+# Asking the server for its tools and converting them costs a
+# round-trip every query. The answer almost never changes, so
+# we remember it for TOOLS_CACHE_TTL seconds per MCP server URL.
+# -------------------------------------------------------
+# url -> (fetched_at, mcp_tools, ollama_tools, invokers)
+_TOOLS_CACHE: dict[str, tuple[float, tuple, tuple, MappingProxyType]] = {}
+_tools_cache_lock = asyncio.Lock()
+
+
+async def get_tools(session: ClientSession, url: str = MCP_SERVER_URL) -> tuple[tuple, tuple, MappingProxyType]:
+    """
+    Returns (mcp_tools, ollama_tools, invokers) for the MCP server at `url`,
+    using the cache when fresh. invokers is the tool-name → invoker dispatch
+    table from build_tool_invokers().
+    
+    All three are read-only so callers can't accidentally modify the shared
+    cached copy.
+    The lock makes concurrent callers wait for ONE list_tools() instead of
+    each firing their own.
+    """
+    async with _tools_cache_lock:
+        cached = _TOOLS_CACHE.get(url)
+        if cached is None or time.monotonic() - cached[0] >= TOOLS_CACHE_TTL:
+            tools_response = await session.list_tools()
+            mcp_tools = tuple(tools_response.tools)
+            llm_tools = tuple(t for t in mcp_tools if t.name not in INTERNAL_TOOLS)
+            cached = _TOOLS_CACHE[url] = (
+                time.monotonic(),
+                mcp_tools,
+                # Convert MCP tools to Ollama format
+                tuple(convert_mcp_tool_to_ollama_format(t) for t in llm_tools),
+                build_tool_invokers(llm_tools, url),
+            )
+        return cached[1:]
+
+
+def invalidate_tools_cache(url: str | None = None):
+    """Forgets the discovered tools for `url` (or for every server), e.g. after adding a tool."""
+    if url is None:
+        _TOOLS_CACHE.clear()
+    else:
+        _TOOLS_CACHE.pop(url, None)
+
+
 # -------------------------------------------------------
 # HELPER FUNCTION: Print formatted output
 # -------------------------------------------------------
@@ -106,64 +317,830 @@ def print_section(title: str, content: str = "", color_code: str = ""):
         print(content)
 
 
-def wait_for_ollama(url: str, model: str, timeout: int = 120):
-    """Wait for Ollama to be reachable and the model to be loaded before starting."""
+async def wait_for_ollama(url: str, model: str, timeout: int = 120):
+    """
+    Wait for Ollama to be reachable and the model to be loaded before starting.
+    
+    Polls quickly at first and backs off (0.25s, 0.5s, 1s ... up to 5s), so
+    startup is near-instant when Ollama is already up. Everything is async,
+    so other startup work can run while we wait.
+    """
     print(f"  Waiting for Ollama at {url} ...")
-    deadline = time.time() + timeout
-    while time.time() < deadline:
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    async with httpx.AsyncClient(timeout=5) as http:
+        while time.monotonic() < deadline:
+            try:
+                resp = await http.get(f"{url}/api/tags")
+                if resp.status_code == 200:
+                    models = [m["name"] for m in resp.json().get("models", [])]
+                    if any(model in m for m in models):
+                        print(f"  ✓ Ollama is ready (model '{model}' available)")
+                        return
+                    print(f"  Ollama up but model '{model}' not yet available, retrying...")
+            except (httpx.HTTPError, ValueError, KeyError, TypeError, AttributeError):
+                # Not reachable yet, or a half-started Ollama answered
+                # with something other than the model list (not JSON,
+                # "models": null, a list, ...) - try again
+                pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+    print(f"  ✗ Timed out waiting for Ollama after {timeout}s")
+    raise TimeoutError(f"Ollama at {url} not ready after {timeout}s")
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Normalize tool arguments
+# -------------------------------------------------------
+# tool_args might come back as a string or dict depending
+# on the Ollama version - this always hands back a dict.
+# -------------------------------------------------------
+def normalize_tool_args(tool_args) -> dict:
+    """Turns the LLM's tool arguments into a dict (empty if they can't be parsed)."""
+    if isinstance(tool_args, str):
         try:
-            resp = httpx.get(f"{url}/api/tags", timeout=5)
-            if resp.status_code == 200:
-                models = [m["name"] for m in resp.json().get("models", [])]
-                if any(model in m for m in models):
-                    print(f"  ✓ Ollama is ready (model '{model}' available)")
-                    return
-                print(f"  Ollama up but model '{model}' not yet available, retrying...")
-        except Exception:
+            tool_args = orjson.loads(tool_args)
+        except orjson.JSONDecodeError:
+            return {}
+    return tool_args if isinstance(tool_args, dict) else {}
+
+
+def tool_call_key(tool_name: str, tool_args: dict) -> tuple[str, bytes]:
+    """A hashable key that is identical for identical calls (argument order ignored)."""
+    return (tool_name, orjson.dumps(tool_args, option=orjson.OPT_SORT_KEYS))
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Compact a JSON tool result
+# -------------------------------------------------------
+# Our server already sends compact JSON, but other MCP servers may
+# pretty-print - and every space is a token the LLM has to read, on
+# every later iteration too. This is the ONE place a tool result is
+# parsed: it is re-serialized compactly, with sorted keys so identical
+# results always produce identical text, minus TOOL_RESULT_DROP_FIELDS.
+# -------------------------------------------------------
+def compact_tool_result(text: str) -> str:
+    """Returns the tool result as compact JSON (or unchanged if it isn't JSON)."""
+    if not text.lstrip().startswith(("{", "[")):
+        return text
+    try:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return text
+    if isinstance(data, dict):
+        data = {k: v for k, v in data.items() if k not in TOOL_RESULT_DROP_FIELDS}
+    return orjson.dumps(data, option=orjson.OPT_SORT_KEYS).decode()
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Is this an internal IP?
+# -------------------------------------------------------
+# Lots of SOC alert noise is internal (RFC1918) traffic. The LLM
+# still tends to look those IPs up, which just wastes a round-trip:
+# no threat feed or geolocation service knows anything about them.
+#
+# The MCP server answers internal IPs the same way (server.py:
+# _skip_ip_lookup), so the LLM sees one answer whichever side
+# handled the call - keep the two in step.
+# -------------------------------------------------------
+PRIVATE_IP_FASTPATH_TOOLS = frozenset({"check_ip_reputation", "lookup_ip_geolocation"})
+
+
+def is_internal_ip(value) -> bool:
+    """True for private, loopback, link-local and multicast addresses."""
+    if not isinstance(value, str):
+        return False
+    try:
+        ip = ipaddress.ip_address(value)
+    except ValueError:
+        return False
+    return ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_multicast
+
+
+def internal_ip_result(ip_address: str) -> str:
+    """The answer for an internal IP - identical to the MCP server's (after compact_tool_result)."""
+    return orjson.dumps({
+        "ip": ip_address,
+        "is_private": True,
+        "recommendation": "IGNORE - internal",
+    }).decode()
+
+
+# -------------------------------------------------------
+# Speculation is only safe after "leaf" lookups: tools whose
+# results never change WHICH tools the LLM calls next (checking
+# IP #2 doesn't depend on what we learned about IP #1).
+# -------------------------------------------------------
+SPECULATIVE_SAFE_TOOLS = frozenset({
+    "check_ip_reputation", "lookup_ip_geolocation", "lookup_ip_geolocation_batch"
+})
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Execute one tool call through MCP
+# -------------------------------------------------------
+# Two layers stop us asking the MCP server the same question twice:
+#
+#   1. _TOOL_RESULT_CACHE - finished results, remembered for
+#      TOOL_CACHE_TTL seconds. The system prompt asks the LLM to
+#      correlate alerts, so the same IP gets looked up again and again.
+#
+#   2. _INFLIGHT - calls that are running RIGHT NOW. If an identical
+#      call comes in before the first one finishes (same LLM turn, or
+#      another query in run_soc_agent_batch), it waits for the first one's answer
+#      instead of sending a duplicate request.
+#
+# Both are keyed by the MCP server URL too: two agents talking to
+# different servers must never be handed each other's results.
+# -------------------------------------------------------
+_TOOL_RESULT_CACHE: OrderedDict[tuple[str, str, bytes], tuple[float, str]] = OrderedDict()
+_INFLIGHT: dict[tuple[str, str, bytes], asyncio.Future] = {}
+
+
+async def execute_tool_call(session: ClientSession, tool_name: str, tool_args: dict,
+                            url: str = MCP_SERVER_URL) -> str:
+    """
+    Calls a single tool on the MCP server at `url` (which `session` is
+    connected to) and returns its text result.
+    
+    Identical calls (same server, tool and arguments) share one cached
+    result, and identical calls running at the same time share one request.
+    
+    Errors are turned into an error string instead of being raised, so
+    one failing tool never stops the others running alongside it - the
+    LLM simply sees the error and can decide what to do about it.
+    Errors are never cached.
+    """
+    # Fast path: an internal IP needs no threat-intel or geolocation lookup.
+    # We answer locally and skip the MCP round-trip entirely.
+    if tool_name in PRIVATE_IP_FASTPATH_TOOLS and is_internal_ip(tool_args.get("ip_address")):
+        return internal_ip_result(tool_args["ip_address"])
+    
+    key = (url, *tool_call_key(tool_name, tool_args))
+    
+    while True:
+        # Layer 1: a recent finished result?
+        cached = _TOOL_RESULT_CACHE.get(key)
+        if cached and time.monotonic() - cached[0] < TOOL_CACHE_TTL:
+            _TOOL_RESULT_CACHE.move_to_end(key)
+            return cached[1]
+        
+        # Layer 2: the same call already running? Wait for its answer.
+        # (shield() so that if WE are cancelled, the shared call isn't.)
+        inflight = _INFLIGHT.get(key)
+        if inflight is None:
+            break
+        try:
+            return await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            if not inflight.cancelled():
+                raise  # we were cancelled ourselves
+            # The call we were waiting on was cancelled - go again
+    
+    future = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = future
+    try:
+        tool_result_text, cacheable = await _call_mcp_tool(session, tool_name, tool_args)
+        future.set_result(tool_result_text)
+    except BaseException:
+        future.cancel()
+        raise
+    finally:
+        del _INFLIGHT[key]
+    
+    if cacheable:
+        # Remember the result, evicting the least recently used entry when full
+        _TOOL_RESULT_CACHE[key] = (time.monotonic(), tool_result_text)
+        _TOOL_RESULT_CACHE.move_to_end(key)
+        if len(_TOOL_RESULT_CACHE) > TOOL_CACHE_SIZE:
+            _TOOL_RESULT_CACHE.popitem(last=False)
+    return tool_result_text
+
+
+async def _call_mcp_tool(session: ClientSession, tool_name: str, tool_args: dict) -> tuple[str, bool]:
+    """Makes the actual MCP request. Returns (text, whether it is safe to cache)."""
+    try:
+        # session.call_tool() sends the request to our
+        # MCP server and waits for the result. The semaphore
+        # makes extra calls queue up once TOOL_CONCURRENCY
+        # calls are already running.
+        async with _tool_semaphore:
+            mcp_result = await session.call_tool(tool_name, tool_args)
+    except Exception as e:
+        return f"Tool execution error: {str(e)}", False
+    
+    # Extract the text content from the MCP response
+    # MCP returns a list of content blocks - we want text
+    if not mcp_result.content:
+        return "Tool returned no content", False
+    if mcp_result.isError:
+        return mcp_result.content[0].text, False
+    tool_result_text = compact_tool_result(mcp_result.content[0].text)
+    # A tool may also report a failure as a normal {"error": ...} answer
+    # (e.g. the geolocation service was unreachable) - don't cache that either
+    return tool_result_text, not is_error_payload(tool_result_text)
+
+
+def is_error_payload(tool_result_text: str) -> bool:
+    """True if a tool result is a JSON object with a top-level "error" key."""
+    if not tool_result_text.startswith("{"):
+        return False
+    try:
+        data = orjson.loads(tool_result_text)
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and "error" in data
+
+
+# Every way a tool call can fail shows up as text starting with one of these
+# (our own errors, and the MCP server's "Error executing tool ...")
+TOOL_ERROR_PREFIXES = ("Tool execution error", "Error executing tool", "Tool returned no content")
+
+
+def is_tool_error(tool_result_text: str) -> bool:
+    """True if a tool result is an error message rather than real data."""
+    return tool_result_text.startswith(TOOL_ERROR_PREFIXES)
+
+
+def is_failed_result(tool_result_text: str) -> bool:
+    """True if a tool call failed, whether it says so in text or as {"error": ...}."""
+    return is_tool_error(tool_result_text) or is_error_payload(tool_result_text)
+
+
+# Errors WE raise before anything is sent (see _make_invoker). The same
+# call gives the same error every time, so - unlike a server hiccup or a
+# dropped connection - trying it again is pointless.
+LOCAL_ERROR_PREFIXES = ("Tool execution error: invalid arguments", "Tool execution error: unknown tool")
+
+
+def is_retryable_error(tool_result_text: str) -> bool:
+    """True if the same call might succeed next time (server/transport failures)."""
+    if tool_result_text.startswith(LOCAL_ERROR_PREFIXES):
+        return False
+    return is_failed_result(tool_result_text)
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Build the tool dispatch table
+# -------------------------------------------------------
+# LLMs regularly invent argument names or pass the wrong types.
+# Each MCP tool comes with a JSON Schema for its arguments, so we
+# compile a validator for every tool ONCE at discovery time and
+# reject bad calls locally - no round-trip to the server needed.
+#
+# Only calls the SERVER would reject are rejected here: the server
+# converts simple types ({"limit": "5"} works), so we do too.
+# -------------------------------------------------------
+def build_tool_invokers(mcp_tools, url: str = MCP_SERVER_URL) -> MappingProxyType:
+    """
+    Returns a read-only {tool name: async invoker(session, tool_args)} table
+    for the MCP server at `url` (its results are cached under that URL).
+    
+    Each invoker also has a .prepare(tool_args) function returning the
+    arguments exactly as they will be sent (see _make_invoker).
+    """
+    return MappingProxyType({tool.name: _make_invoker(tool, url) for tool in mcp_tools})
+
+
+def coerce_tool_args(properties: dict, tool_args: dict) -> dict:
+    """
+    Returns a COPY of tool_args with strings converted to the simple type
+    the schema asks for ("5" → 5, "true" → True), like the server does.
+    Values that don't convert are left alone for the validator to report.
+    """
+    coerced = dict(tool_args)
+    for name, value in tool_args.items():
+        if not isinstance(value, str):
+            continue
+        expected = (properties.get(name) or {}).get("type")
+        text = value.strip()
+        try:
+            if expected == "integer":
+                coerced[name] = int(text)
+            elif expected == "number":
+                coerced[name] = float(text)
+            elif expected == "boolean" and text.lower() in ("true", "false"):
+                coerced[name] = text.lower() == "true"
+        except ValueError:
             pass
-        time.sleep(5)
-    print(f"  ✗ Timed out waiting for Ollama after {timeout}s")
-    sys.exit(1)
+    return coerced
+
+
+def _make_invoker(tool, url: str):
+    tool_name = tool.name
+    schema = tool.inputSchema or {"type": "object"}
+    properties = schema.get("properties") or {}
+    try:
+        validate = fastjsonschema.compile(schema)
+    except fastjsonschema.JsonSchemaDefinitionException:
+        # A schema we can't compile shouldn't make the tool unusable
+        validate = None
+    
+    def prepare(tool_args: dict) -> dict:
+        """
+        The arguments as they will be sent: a copy, with simple types
+        converted and default values filled in (e.g. limit=5), so calls
+        with and without the default share one cache entry.
+        Raises fastjsonschema.JsonSchemaValueException for invalid arguments.
+        """
+        tool_args = coerce_tool_args(properties, tool_args)
+        if validate is not None:
+            tool_args = validate(tool_args)  # fills defaults into our copy
+        return tool_args
+    
+    async def invoke(session: ClientSession, tool_args: dict) -> str:
+        try:
+            tool_args = prepare(tool_args)
+        except fastjsonschema.JsonSchemaValueException as e:
+            return f"Tool execution error: invalid arguments for {tool_name}: {e.message}"
+        return await execute_tool_call(session, tool_name, tool_args, url)
+    
+    invoke.prepare = prepare
+    return invoke
+
+
+async def invoke_unknown_tool(session: ClientSession, tool_args: dict, tool_name: str = "") -> str:
+    """Stand-in invoker for a tool name the MCP server never advertised."""
+    return f"Tool execution error: unknown tool '{tool_name}'"
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Answer reputation checks locally
+# -------------------------------------------------------
+# Most external IPs are NOT in the threat feed. With the feed's
+# IP list downloaded once (get_reputation_index), the agent
+# knows that without asking: check_ip_reputation for an unlisted
+# IP is answered here, built from the clean verdict the server
+# sends along with the list - so it is exactly the server's answer.
+# Only IPs that ARE listed still go to the MCP server.
+# -------------------------------------------------------
+async def fetch_reputation_index(session: ClientSession) -> tuple[frozenset, dict] | None:
+    """
+    Downloads (listed IPs, clean verdict) from the threat feed.
+    None if unavailable - then every check goes to the server.
+    """
+    try:
+        result = await session.call_tool("get_reputation_index", {})
+        index = orjson.loads(result.content[0].text)
+        return frozenset(index["malicious_ips"]), dict(index["clean_verdict"])
+    except Exception as e:
+        log.warning("  ! Could not load the reputation index, checking every IP remotely: %s", e)
+        return None
+
+
+async def invoke_clean_reputation(session: ClientSession, tool_args: dict, clean_verdict: dict) -> str:
+    """check_ip_reputation's answer for an IP the reputation index does not list."""
+    # Through compact_tool_result, like a real server answer
+    return compact_tool_result(orjson.dumps({"ip": tool_args["ip_address"], **clean_verdict}).decode())
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Shrink old tool results
+# -------------------------------------------------------
+# Once the LLM has read a tool result it only needs the verdict,
+# not every field: "is_malicious=True threat_type=Tor Exit Node"
+# says it all. These are the fields kept in the one-line summary,
+# in this order; everything else is dropped.
+# -------------------------------------------------------
+SUMMARY_FIELDS = (
+    "id", "ip", "source_ip", "destination_ip", "event_type", "severity",
+    "is_malicious", "threat_type", "confidence_score",
+    "country", "organization", "is_private", "error",
+)
+
+
+def summarize_tool_result(tool_name: str, text: str) -> str:
+    """Returns a one-line summary of a tool result, keeping only SUMMARY_FIELDS."""
+    try:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return f"[{tool_name} returned: {text[:200]}]"
+    
+    def fields(item) -> str:
+        if not isinstance(item, dict):
+            return str(item)[:200]
+        summary = " ".join(f"{k}={item[k]}" for k in SUMMARY_FIELDS if k in item)
+        return summary or text[:200]  # none of the fields we know about
+    
+    # A list of alerts (or batch results): one short entry per item,
+    # so no alert ID or IP is lost
+    if isinstance(data, dict):
+        for key in ("alerts", "results"):
+            if isinstance(data.get(key), list):
+                return f"[{tool_name} returned: " + "; ".join(fields(item) for item in data[key]) + "]"
+    return f"[{tool_name} returned: {fields(data)}]"
+
+
+def compact_tool_history(messages: list, tool_log: list) -> None:
+    """
+    Replaces all but the newest MAX_HISTORY_TOOL_MSGS tool results with a summary.
+    
+    tool_log holds (index in messages, tool name) for every tool result that
+    is still full-length; entries are removed from it once summarized.
+    """
+    cutoff = max(len(tool_log) - MAX_HISTORY_TOOL_MSGS, 0)
+    for index, tool_name in tool_log[:cutoff]:
+        messages[index] = {
+            "role": "tool",
+            "content": summarize_tool_result(tool_name, messages[index]["content"])
+        }
+    del tool_log[:cutoff]
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Record the LLM's turn in the conversation
+# -------------------------------------------------------
+def assistant_message(content: str, calls) -> dict:
+    """
+    Builds the assistant message for one LLM turn.
+    
+    calls is a sequence of (tool_name, tool_args). The tool_calls key is
+    only added when there ARE calls, so a final answer stays a small
+    two-key dict and no empty list is built for it.
+    """
+    message = {"role": "assistant", "content": content}
+    if calls:
+        message["tool_calls"] = [
+            {"function": {"name": tool_name, "arguments": tool_args}}
+            for tool_name, tool_args in calls
+        ]
+    return message
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Put a streamed LLM response back together
+# -------------------------------------------------------
+async def accumulate_streaming_response(stream, on_tool_call=None):
+    """
+    Collects a streamed Ollama chat response into a single ChatResponse.
+
+    With stream=True Ollama sends many small chunks: pieces of text, and
+    each tool call as soon as the model finishes writing it. This glues the
+    text back together and collects the tool calls in order, so the result
+    has the same .message.content / .message.tool_calls shape as a
+    non-streaming call.
+
+    The usage stats (prompt_eval_count, eval_count, total_duration, ...)
+    only arrive on the final chunk, so that chunk is the one returned.
+
+    on_tool_call(tool_call) is called for each tool call the moment it
+    arrives - this is how the agent starts tools before the LLM is done.
+    """
+    content_parts = []
+    tool_calls = []
+    last_chunk = None
+
+    async for chunk in stream:
+        last_chunk = chunk
+        if chunk.message.content:
+            content_parts.append(chunk.message.content)
+        for tc in chunk.message.tool_calls or []:
+            tool_calls.append(tc)
+            if on_tool_call is not None:
+                on_tool_call(tc)
+
+    if last_chunk is None:
+        raise RuntimeError("Ollama returned an empty response stream")
+
+    message = last_chunk.message.model_copy(update={
+        "content": "".join(content_parts),
+        "tool_calls": tool_calls or None,
+    })
+    return last_chunk.model_copy(update={"message": message})
+
+
+# -------------------------------------------------------
+# HELPER FUNCTION: Turn a plan into parallel groups
+# -------------------------------------------------------
+# The planner's answer is a small dependency graph ("DAG"):
+#
+#   n1 get_recent_alerts          deps: []
+#   n2 check_ip_reputation(A)     deps: []
+#   n3 lookup_ip_geolocation(A)   deps: []
+#   n4 get_alert_details(X)       deps: [n1]
+#
+# Every call whose deps are finished can run at the same time, so
+# this becomes [[n1, n2, n3], [n4]] - two rounds of parallel calls.
+# -------------------------------------------------------
+def plan_groups(plan, tool_names) -> list[list[dict]]:
+    """
+    Checks a planner DAG and sorts its nodes into groups that can run in parallel.
+    
+    Raises ValueError if the plan is malformed, uses a tool that doesn't
+    exist, or has dependencies that can never be met (unknown ids, cycles).
+    """
+    nodes = plan.get("nodes") if isinstance(plan, dict) else None
+    if not isinstance(nodes, list) or not nodes:
+        raise ValueError("plan has no nodes")
+    
+    by_id = {}
+    for node in nodes:
+        if not isinstance(node, dict) or not isinstance(node.get("id"), str):
+            raise ValueError(f"malformed plan node: {node!r}")
+        if node.get("tool") not in tool_names:
+            raise ValueError(f"plan uses unknown tool {node.get('tool')!r}")
+        if not isinstance(node.get("deps", []), list):
+            raise ValueError(f"plan node {node['id']} has malformed deps")
+        if node["id"] in by_id:
+            raise ValueError(f"plan node id {node['id']} is used twice")
+        by_id[node["id"]] = {
+            "id": node["id"],
+            "tool": node["tool"],
+            "args": normalize_tool_args(node.get("args")),
+            "deps": node.get("deps", []),
+        }
+    
+    for node in by_id.values():
+        for dep in node["deps"]:
+            if dep not in by_id:
+                raise ValueError(f"plan node {node['id']} depends on unknown node {dep!r}")
+    
+    # Peel off everything whose deps are done, round by round
+    groups, done = [], set()
+    remaining = list(by_id.values())
+    while remaining:
+        ready = [node for node in remaining if all(dep in done for dep in node["deps"])]
+        if not ready:
+            raise ValueError("plan has a dependency cycle")
+        groups.append(ready)
+        done.update(node["id"] for node in ready)
+        remaining = [node for node in remaining if node["id"] not in done]
+    return groups
 
 
 # ===================================================
-# THE MAIN AGENT FUNCTION
+# THE ASSESSMENT CACHE
+# ===================================================
+# A full investigation takes many LLM calls. If someone asks a
+# question we answered a few minutes ago, just hand back that answer.
+#
+#   Tier 1 - exact:    same question (ignoring case/whitespace)
+#   Tier 2 - semantic: a question that MEANS the same thing, found by
+#                      comparing embeddings (lists of numbers that
+#                      capture meaning) with cosine similarity
 # ===================================================
-async def run_soc_agent(user_query: str):
+# IP addresses and alert IDs in a question. Two questions only count as
+# "the same" if they mention exactly the same ones - "Is 1.2.3.4 bad?" and
+# "Is 5.6.7.8 bad?" embed almost identically but need different answers.
+_ENTITY_PATTERN = re.compile(r"\b(?:\d{1,3}(?:\.\d{1,3}){3}|ALT-\d+)\b", re.IGNORECASE)
+
+
+class AssessmentCache:
+    """Caches final assessments by exact question and (optionally) by meaning."""
+    
+    def __init__(self, ttl: float = ASSESSMENT_CACHE_TTL, size: int = ASSESSMENT_CACHE_SIZE,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        self.ttl = ttl
+        self.size = size
+        self.threshold = threshold
+        # normalized question -> (stored_at, entities, unit-length embedding or None, answer)
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+    
+    @staticmethod
+    def _normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+    
+    def lookup(self, query: str, embedding: list | None = None) -> str | None:
+        """Returns a cached answer for this question, or None."""
+        if self.ttl <= 0:
+            return None
+        now = time.monotonic()
+        
+        # Drop expired entries (oldest are at the front)
+        while self._entries and now - next(iter(self._entries.values()))[0] >= self.ttl:
+            self._entries.popitem(last=False)
+        
+        # Tier 1: exact match
+        entry = self._entries.get(self._normalize(query))
+        if entry is not None:
+            return entry[3]
+        
+        # Tier 2: closest earlier question by meaning
+        if embedding is None:
+            return None
+        entities = self._entities(query)
+        best_score, best_answer = 0.0, None
+        for stored_at, stored_entities, stored_embedding, answer in self._entries.values():
+            if stored_embedding is None or stored_entities != entities:
+                continue
+            score = sum(a * b for a, b in zip(embedding, stored_embedding))
+            if score > best_score:
+                best_score, best_answer = score, answer
+        if best_score >= self.threshold:
+            log.debug("  Semantic cache hit (similarity %.3f)", best_score)
+            return best_answer
+        return None
+    
+    def store(self, query: str, answer: str, embedding: list | None = None):
+        """Remembers the answer to a question."""
+        if self.ttl <= 0:
+            return
+        key = self._normalize(query)
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic(), self._entities(query), embedding, answer)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+    
+    @staticmethod
+    def _entities(query: str) -> frozenset:
+        return frozenset(m.upper() for m in _ENTITY_PATTERN.findall(query))
+
+
+def unit_vector(vector) -> list:
+    """Scales a vector to length 1, so cosine similarity is a plain dot product."""
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+# ===================================================
+# THE MCP SESSION POOL
+# ===================================================
+# Opening an MCP session means an HTTP connection, an SSE stream
+# and an initialize() handshake. For an agent that handles many
+# queries, we open sessions once and hand them out again and again.
+# ===================================================
+class MCPSessionPool:
     """
-    The main agent loop. 
-    
-    This function:
-    1. Connects to MCP server
-    2. Discovers tools
-    3. Sends query to LLM with tools available
-    4. Executes tool calls the LLM requests
-    5. Feeds tool results back to LLM
-    6. Repeats until LLM has a final answer
+    A small pool of ready-to-use MCP sessions for one server URL.
+    
+    Sessions are opened lazily (only when needed) up to `size`. acquire()
+    hands out an idle session, release() gives it back. Sessions that sat
+    idle for a while are pinged first; dead ones, and ones older than
+    `max_age` seconds, are replaced.
+    
+    Use it as `async with MCPSessionPool(url) as pool:` to have it closed
+    automatically.
+    
+    Each session lives in its own background task: the SSE client must be
+    closed by the same task that opened it, and the tasks that USE a
+    session (e.g. concurrent analyze() calls) come and go.
     """
     
-    print_section("SOC ANALYST AGENT - STARTING")
-    print(f"  Model:      {MODEL}")
-    print(f"  MCP Server: {MCP_SERVER_URL}")
-    print(f"  Ollama:     {OLLAMA_URL}")
+    # Only ping a session before reuse if it has been idle this long (seconds)
+    PING_AFTER = 30.0
+    
+    def __init__(self, url: str = MCP_SERVER_URL, size: int = MCP_POOL_SIZE,
+                 max_age: float = MCP_SESSION_MAX_AGE):
+        self.url = url
+        self.size = size
+        self.max_age = max_age
+        self._idle = asyncio.Queue()   # (session, released_at) pairs
+        self._opened = 0
+        self._owners = {}              # session -> (stop event, owner task, opened_at)
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.close()
+    
+    async def acquire(self) -> ClientSession:
+        """Returns a healthy session, opening a new one if the pool isn't full."""
+        while True:
+            try:
+                session, released_at = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                if self._opened < self.size:
+                    return await self._open()
+                # Pool is full and every session is busy - wait for one
+                session, released_at = await self._idle.get()
+            
+            if await self._is_healthy(session, released_at):
+                return session
+            await self._discard(session)
+    
+    def release(self, session: ClientSession):
+        """Puts a session back in the pool for the next caller."""
+        if session in self._owners:
+            self._idle.put_nowait((session, time.monotonic()))
+    
+    @asynccontextmanager
+    async def session(self):
+        """async with pool.session() as session: ... (always released afterwards)"""
+        session = await self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+    
+    async def close(self):
+        """Closes every session in the pool."""
+        for session in list(self._owners):
+            await self._discard(session)
+    
+    async def _open(self) -> ClientSession:
+        self._opened += 1
+        ready = asyncio.get_running_loop().create_future()
+        stop = asyncio.Event()
+        
+        async def hold_open():
+            # sse_client() creates an HTTP connection to our MCP server
+            # It returns two stream objects (read/write) that ClientSession uses
+            try:
+                async with sse_client(self.url) as (read_stream, write_stream):
+                    async with ClientSession(read_stream, write_stream) as session:
+                        # Initialize the MCP session (handshake)
+                        await session.initialize()
+                        ready.set_result(session)
+                        await stop.wait()
+            except BaseException as e:
+                if not ready.done():
+                    ready.set_exception(e)
+                elif not isinstance(e, asyncio.CancelledError):
+                    log.warning("  ! MCP session closed unexpectedly: %s", e)
+        
+        task = asyncio.create_task(hold_open())
+        try:
+            session = await ready
+        except BaseException:
+            self._opened -= 1
+            task.cancel()
+            raise
+        self._owners[session] = (stop, task, time.monotonic())
+        return session
+    
+    async def _is_healthy(self, session: ClientSession, released_at: float) -> bool:
+        stop, task, opened_at = self._owners[session]
+        if task.done() or time.monotonic() - opened_at > self.max_age:
+            return False
+        if time.monotonic() - released_at < self.PING_AFTER:
+            return True
+        try:
+            await asyncio.wait_for(session.send_ping(), timeout=5)
+            return True
+        except Exception:
+            return False
+    
+    async def _discard(self, session: ClientSession):
+        stop, task, _ = self._owners.pop(session)
+        self._opened -= 1
+        stop.set()
+        try:
+            await task
+        except BaseException:
+            pass
 
-    # Wait for Ollama and the model to be available before proceeding
-    wait_for_ollama(OLLAMA_URL, MODEL)
 
-    # -------------------------------------------------------
-    # STEP 1: Connect to MCP Server
-    # -------------------------------------------------------
-    # sse_client() creates an HTTP connection to our MCP server
-    # It returns two stream objects (read/write) that ClientSession uses
-    # -------------------------------------------------------
-    print_section("STEP 1: Connecting to MCP Server")
+# ===================================================
+# THE AGENT
+# ===================================================
+class SocAgent:
+    """
+    A long-lived SOC analyst agent.
     
-    try:
-        async with sse_client(MCP_SERVER_URL) as (read_stream, write_stream):
-            async with ClientSession(read_stream, write_stream) as session:
-                
-                # Initialize the MCP session (handshake)
-                await session.initialize()
+    Opening the agent (async with SocAgent() as agent) does the expensive
+    setup ONCE:
+    1. Waits for Ollama
+    2. Connects to MCP server (opens the session pool)
+    3. Discovers tools
+    
+    After that, analyze() can be called as many times as you like and
+    only runs the agent loop, borrowing an already-open MCP session:
+    4. Sends query to LLM with tools available
+    5. Executes tool calls the LLM requests
+    6. Feeds tool results back to LLM
+    7. Repeats until LLM has a final answer
+    """
+    
+    def __init__(self, pool: MCPSessionPool | None = None):
+        # Pass in a pool to share MCP sessions with other code; the agent
+        # only closes the pool on exit if it created the pool itself
+        self._owns_pool = pool is None
+        self.pool = pool or MCPSessionPool()
+        self.client = None
+        self.ollama_tools = ()
+        self.invokers = MappingProxyType({})
+        self.reputation_index = None  # IPs in the threat feed (None = unknown)
+        self.clean_verdict = None     # the server's answer for unlisted IPs
+        self.assessments = AssessmentCache()
+    
+    async def __aenter__(self):
+        print_section("SOC ANALYST AGENT - STARTING")
+        print(f"  Model:      {MODEL}")
+        print(f"  MCP Server: {MCP_SERVER_URL}")
+        print(f"  Ollama:     {OLLAMA_URL}")
+        
+        # Client-side concurrency only helps if the Ollama server will
+        # actually decode several requests at once. That is set on the
+        # Ollama SERVER, which the agent can't see - so just a reminder.
+        log.info("  Reminder: parallel queries only decode in parallel if the Ollama "
+                 "server runs with OLLAMA_NUM_PARALLEL >= 4 (see docker-compose.yml)")
+        
+        # Start waiting for Ollama and the model IN THE BACKGROUND.
+        # Ollama readiness and the MCP connection don't depend on each
+        # other, so startup takes max(ollama, mcp) instead of the sum.
+        ollama_ready = asyncio.create_task(wait_for_ollama(OLLAMA_URL, MODEL))
+        
+        # -------------------------------------------------------
+        # STEP 1: Connect to MCP Server
+        # -------------------------------------------------------
+        # The pool opens the first session now (so connection problems
+        # show up immediately) and keeps it open for later queries.
+        # -------------------------------------------------------
+        print_section("STEP 1: Connecting to MCP Server")
+        
+        try:
+            async with self.pool.session() as session:
                 print("  ✓ Connected to MCP server successfully")
                 
                 # -------------------------------------------------------
@@ -176,177 +1153,543 @@ async def run_soc_agent(user_query: str):
                 # -------------------------------------------------------
                 print_section("STEP 2: Discovering Tools from MCP Server")
                 
-                tools_response = await session.list_tools()
-                mcp_tools = tools_response.tools
+                mcp_tools, self.ollama_tools, self.invokers = await get_tools(session, self.pool.url)
                 
                 print(f"  Found {len(mcp_tools)} tools:")
                 for tool in mcp_tools:
                     print(f"    → {tool.name}: {tool.description[:60]}...")
                 
-                # Convert MCP tools to Ollama format
-                ollama_tools = [convert_mcp_tool_to_ollama_format(t) for t in mcp_tools]
-                
-                # -------------------------------------------------------
-                # STEP 3: Set up the conversation
-                # -------------------------------------------------------
-                # The "system prompt" defines the agent's role and behavior.
-                # This is how you instruct the LLM to act like a SOC analyst.
-                # The quality of this prompt significantly affects agent behavior!
-                # -------------------------------------------------------
-                print_section("STEP 3: Initializing Agent")
+                if any(tool.name == "get_reputation_index" for tool in mcp_tools):
+                    index = await fetch_reputation_index(session)
+                    if index is not None:
+                        self.reputation_index, self.clean_verdict = index
+                        print(f"  ✓ Reputation index loaded ({len(self.reputation_index)} listed IPs)")
+            
+            # Both halves of startup must be done before we continue
+            await ollama_ready
+        
+        except ConnectionRefusedError:
+            ollama_ready.cancel()
+            await self._close_pool()
+            print(f"\n  ✗ ERROR: Could not connect to MCP server at {MCP_SERVER_URL}")
+            print("    Is the mcp-server container running? Try: docker compose ps")
+            sys.exit(1)
+        except BaseException as e:
+            ollama_ready.cancel()
+            await self._close_pool()
+            print(f"\n  ✗ ERROR: {str(e) or type(e).__name__}")
+            raise
+        
+        # Create the Ollama client pointing to our local Ollama instance.
+        # We use the ASYNC client: a chat call can take seconds to
+        # minutes, and the sync client would freeze the whole event
+        # loop (including the MCP connection) while the LLM thinks.
+        self.client = ollama.AsyncClient(host=OLLAMA_URL)
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self._close_pool()
+    
+    async def _close_pool(self):
+        # Close every pooled MCP session (and its SSE connection)
+        if self._owns_pool:
+            await self.pool.close()
+    
+    async def analyze(self, user_query: str) -> str:
+        """Runs the agent loop for one query and returns the final assessment."""
+        # Asked (something like) this recently? Skip the whole investigation.
+        embedding = None
+        cached = self.assessments.lookup(user_query)
+        if cached is None:
+            embedding = await self._embed(user_query)
+            if embedding is not None:
+                cached = self.assessments.lookup(user_query, embedding)
+        if cached is not None:
+            print_section("FINAL THREAT ASSESSMENT (cached)", cached)
+            return cached
+        
+        # Borrow an open MCP session for the length of this query
+        async with self.pool.session() as session:
+            prefetch = self._prefetch_alerts(session)
+            try:
+                assessment, degraded = await self._investigate(session, user_query, prefetch)
+            finally:
+                if prefetch is not None:
+                    prefetch.cancel()  # no-op if it already finished
+        
+        # Only remember a complete answer built from working tools - if a
+        # lookup failed, the next identical question deserves a fresh try
+        if assessment.strip() and not degraded and assessment != MAX_ITERATIONS_MESSAGE:
+            self.assessments.store(user_query, assessment, embedding)
+        return assessment
+    
+    async def _embed(self, text: str) -> list | None:
+        """Embeds text with EMBED_MODEL for the semantic cache (None if disabled or failing)."""
+        if not EMBED_MODEL or ASSESSMENT_CACHE_TTL <= 0:
+            return None
+        try:
+            response = await self.client.embed(model=EMBED_MODEL, input=text, keep_alive=OLLAMA_KEEP_ALIVE)
+            return unit_vector(response.embeddings[0])
+        except Exception as e:
+            log.debug("  Embedding failed, semantic cache skipped: %s", e)
+            return None
+    
+    def _call_key(self, tool_name: str, tool_args: dict) -> tuple[str, bytes]:
+        """
+        tool_call_key() of the arguments as the invoker will really send
+        them - so {} and {"limit": 5} count as the same get_recent_alerts call.
+        """
+        invoke = self.invokers.get(tool_name)
+        if invoke is not None:
+            try:
+                tool_args = invoke.prepare(tool_args)
+            except fastjsonschema.JsonSchemaValueException:
+                pass  # invalid either way - compare as written
+        return tool_call_key(tool_name, tool_args)
+    
+    def _prefetch_alerts(self, session: ClientSession) -> asyncio.Task | None:
+        """
+        Starts the get_recent_alerts call the LLM is told to make first.
+        
+        The result lands in the in-flight map / result cache, so when the
+        LLM asks for the same call it simply joins (or reuses) this one.
+        """
+        if not PREFETCH_ALERTS or "get_recent_alerts" not in self.invokers:
+            return None
+        task = asyncio.create_task(
+            execute_tool_call(session, "get_recent_alerts", PREFETCH_ALERTS_ARGS, self.pool.url)
+        )
+        # Nobody may ever await it - don't warn about an unretrieved error
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+    
+    async def _investigate(self, session: ClientSession, user_query: str,
+                           prefetch: asyncio.Task | None = None) -> tuple[str, bool]:
+        """Returns (final assessment, whether any tool call along the way failed)."""
+        # -------------------------------------------------------
+        # STEP 3: Set up the conversation
+        # -------------------------------------------------------
+        print_section("STEP 3: Initializing Agent")
+        
+        # messages is our conversation history
+        # We start with the system prompt + the user's question
+        #
+        # Ollama caches the work it did reading the start of the previous
+        # prompt (its "KV cache") and skips re-reading any prefix that is
+        # unchanged. So we ONLY ever append to this list and never touch
+        # messages[0]: the system prompt (identical for every query) plus
+        # the conversation so far is read once instead of every iteration.
+        # compact_tool_history() is the one exception - it rewrites OLD
+        # tool results, trading some cache reuse for a shorter prompt.
+        messages = [*_BASE_MESSAGES, {"role": "user", "content": user_query}]
+        
+        print(f"  ✓ Agent initialized with {len(self.ollama_tools)} tools available")
+        print(f"\n  USER QUERY: {user_query}")
+        
+        # -------------------------------------------------------
+        # STEP 4: THE AGENT LOOP
+        # -------------------------------------------------------
+        # This is the core of how agents work:
+        # 
+        #   LLM decides action
+        #       ↓
+        #   If "use a tool" → run tool → add result to conversation
+        #       ↓                              ↓
+        #   Loop back ←────────────────────────┘
+        #       ↓
+        #   If "I have enough info" → write final answer → DONE
+        #
+        # -------------------------------------------------------
+        print_section("STEP 4: Agent Loop Running")
+        
+        iteration = 0  # Safety counter
+        tool_log = []  # (message index, tool name) of full-length tool results
+        speculative = None  # next LLM response, decoded ahead of time (AGENT_SPECULATIVE)
+        seen = {}  # _call_key → result of every tool call not worth retrying
+        failures = []  # names of the tool calls that came back as errors
+        
+        # Plan mode: run every planned tool call up front. The loop below
+        # then starts with all the results in hand - usually the LLM
+        # writes its assessment straight away (the "executor" step).
+        if AGENT_MODE == "plan":
+            iteration += 1
+            print(f"\n  [Iteration {iteration}/{MAX_ITERATIONS}] Asking the LLM for a plan...")
+            if await self._run_plan(session, messages, tool_log, seen, failures, prefetch):
+                prefetch = None  # the plan has used it
+        
+        while iteration < MAX_ITERATIONS:
+            iteration += 1
+            
+            # ── Ask the LLM what to do next ──────────────────────
+            # We send the full conversation history + available tools
+            # The LLM will either:
+            #   A) Call one or more tools (it needs more info)
+            #   B) Write a final text answer (it's done)
+            #
+            # The answer is STREAMED back, and every tool call is sent
+            # to MCP as soon as it appears - so tools start running
+            # while the LLM is still writing the rest of its answer.
+            # ─────────────────────────────────────────────────────
+            if speculative is None:
+                print(f"\n  [Iteration {iteration}/{MAX_ITERATIONS}] Querying LLM...")
+                content, tool_calls, prepared, pending = await self._chat_and_dispatch(session, messages, seen=seen)
                 
-                system_prompt = """You are a skilled SOC (Security Operations Center) analyst.
-Your job is to investigate security alerts and provide threat assessments.
-
-IMPORTANT: You have tools available. You MUST call them to gather data — do NOT write out JSON or describe tool calls in text. Use the actual tool-calling mechanism provided to you.
+                # Didn't ask for the prefetched alerts after all? Stop that call.
+                if prefetch is not None:
+                    wanted = self._call_key("get_recent_alerts", PREFETCH_ALERTS_ARGS)
+                    if all(self._call_key(name, args) != wanted for name, args in prepared):
+                        prefetch.cancel()
+                    prefetch = None
+            else:
+                print(f"\n  [Iteration {iteration}/{MAX_ITERATIONS}] Using speculative LLM response")
+                content, tool_calls, prepared, _ = speculative
+                pending = [self._start_tool(session, name, args, seen) for name, args in prepared]
+                speculative = None
+            
+            # Add the LLM's response to our conversation history
+            # (We need to track the full conversation so the LLM
+            #  has context on what it's already done)
+            messages.append(assistant_message(content, prepared))
+            
+            # ── Check: is the LLM done? ───────────────────────────
+            # If there are no tool_calls, the LLM has written its
+            # final analysis. We're done!
+            # ─────────────────────────────────────────────────────
+            if not tool_calls:
+                print("  ✓ LLM has reached a conclusion (no more tool calls)")
+                print_section("FINAL THREAT ASSESSMENT", content)
+                return content, bool(failures)
+            
+            # ── Wait for the tool calls ───────────────────────────
+            # They are already running (started during the stream),
+            # and they run AT THE SAME TIME - the tool calls in one
+            # LLM turn are independent of each other (e.g. reputation
+            # + geolocation for the same IP), so this takes roughly
+            # as long as the SLOWEST call, not the sum.
+            # ─────────────────────────────────────────────────────
+            print(f"  LLM called {len(tool_calls)} tool(s), waiting for results...")
+            speculation = None
+            if (AGENT_SPECULATIVE
+                    and all(name in SPECULATIVE_SAFE_TOOLS for name, _ in prepared)
+                    and not all(task.done() for task in pending)):
+                speculation = asyncio.create_task(self._speculate(messages, len(prepared)))
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            
+            # ── Feed tool results back to LLM ─────────────────────
+            # This is crucial - we add the tool results to the
+            # conversation so the LLM can use the information.
+            # gather() returns results in the SAME order the LLM
+            # asked for them, which is the order the LLM expects.
+            # ─────────────────────────────────────────────────────
+            #
+            # A call that already SUCCEEDED earlier (same tool, same
+            # arguments) was never sent again - it is answered with a
+            # reminder instead, as the LLM may not have noticed it has
+            # that result. The same goes for a call WE rejected (bad
+            # arguments, unknown tool): it would only fail again. A call
+            # the SERVER failed is a fair retry: it runs again and the
+            # LLM sees the fresh result.
+            # ─────────────────────────────────────────────────────
+            repeats = 0
+            for (tool_name, tool_args), tool_result_text in zip(prepared, results):
+                if isinstance(tool_result_text, BaseException):
+                    tool_result_text = f"Tool execution error: {str(tool_result_text)}"
+                key = self._call_key(tool_name, tool_args)
+                if key in seen:
+                    repeats += 1
+                    tool_result_text = (f"You already called {tool_name} with these arguments. "
+                                        f"The result was: {seen[key]}")
+                else:
+                    if is_failed_result(tool_result_text):
+                        failures.append(tool_name)
+                    if not is_retryable_error(tool_result_text):
+                        seen[key] = tool_result_text
+                print(f"\n    ✓ {tool_name} → {tool_result_text[:120]}...")
+                tool_log.append((len(messages), tool_name))
+                messages.append({
+                    "role": "tool",
+                    "content": tool_result_text
+                })
+            
+            # Keep the conversation from ballooning on long investigations
+            compact_tool_history(messages, tool_log)
+            
+            # ── Check: is the LLM going round in circles? ─────────
+            # If EVERY call this turn was a repeat, another turn with
+            # tools would most likely just repeat them again. Ask for
+            # the final answer, with no tools on offer.
+            # ─────────────────────────────────────────────────────
+            if repeats == len(prepared):
+                if speculation is not None:
+                    speculation.cancel()
+                print("  ↺ LLM only repeated earlier tool calls - asking for the final answer")
+                messages.append({"role": "system", "content": FINAL_ANSWER_NUDGE})
+                content, *_ = await self._chat_and_dispatch(session, messages, dispatch=False, tools=())
+                messages.append(assistant_message(content, ()))
+                print_section("FINAL THREAT ASSESSMENT", content)
+                return content, bool(failures)
+            
+            # Now the real results are in, decide whether the speculative
+            # response (decoded without them) can stand in for the next turn
+            if speculation is not None:
+                speculative = await self._check_speculation(speculation, prepared)
+        
+        # If we hit MAX_ITERATIONS, something went wrong
+        print_section("WARNING: Maximum iterations reached without conclusion")
+        return MAX_ITERATIONS_MESSAGE, bool(failures)
+    
+    async def _run_plan(self, session: ClientSession, messages: list, tool_log: list,
+                        seen: dict, failures: list, prefetch: asyncio.Task | None) -> bool:
+        """
+        Plan mode: asks the LLM for a DAG of tool calls and runs it, group by group.
+        
+        The calls and their results are added to messages as if the LLM had
+        made them itself, so the normal agent loop can carry on from there.
+        Results not worth retrying go into seen, and failed calls into failures.
+        Returns False (and leaves messages untouched) if no usable plan came back.
+        """
+        # The planner can only plan lookups for IPs it has seen, so it gets
+        # the recent alerts up front (usually already prefetched).
+        alerts_args = PREFETCH_ALERTS_ARGS
+        if prefetch is not None:
+            alerts = await prefetch
+        elif "get_recent_alerts" in self.invokers:
+            alerts = await execute_tool_call(session, "get_recent_alerts", alerts_args, self.pool.url)
+        else:
+            alerts = None
+        
+        tool_lines = []
+        for tool in self.ollama_tools:
+            function = tool["function"]
+            params = ", ".join((function.get("parameters") or {}).get("properties", {}))
+            description = (function.get("description") or "").strip().split("\n")[0]
+            tool_lines.append(f"- {function['name']}({params}): {description}")
+        
+        request = messages[-1]["content"]
+        if alerts is not None:
+            request += f"\n\nRecent alerts (already fetched):\n{alerts}"
+        try:
+            stream = await self.client.chat(
+                model=MODEL,
+                messages=[
+                    {"role": "system", "content": PLANNER_PROMPT + "\n".join(tool_lines)},
+                    {"role": "user", "content": request}
+                ],
+                format="json",  # Ollama only lets the LLM write valid JSON
+                stream=True,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                options={"num_ctx": OLLAMA_NUM_CTX}
+            )
+            response = await accumulate_streaming_response(stream)
+            groups = plan_groups(orjson.loads(response.message.content), self.invokers)
+        except Exception as e:
+            print(f"  ↺ No usable plan ({e}), falling back to the agent loop")
+            return False
+        
+        n_calls = sum(len(group) for group in groups)
+        print(f"  ✓ Plan: {n_calls} tool call(s) in {len(groups)} parallel group(s)")
+        
+        # Record the alerts as the first tool call, then every planned call
+        calls, results = [], []
+        if alerts is not None:
+            calls.append(("get_recent_alerts", alerts_args))
+            results.append(alerts)
+        # Compared with defaults filled in: a planned get_recent_alerts
+        # with no args is the same call as {"limit": 5}
+        alerts_key = self._call_key("get_recent_alerts", alerts_args)
+        for number, group in enumerate(groups, 1):
+            if alerts is not None:
+                # Already have these - don't add them to the conversation twice
+                group = [node for node in group if self._call_key(node["tool"], node["args"]) != alerts_key]
+                if not group:
+                    continue
+            print(f"\n  Plan group {number}/{len(groups)}: {len(group)} tool call(s)")
+            group_results = await asyncio.gather(
+                *(self._start_tool(session, node["tool"], node["args"]) for node in group),
+                return_exceptions=True
+            )
+            for node, tool_result_text in zip(group, group_results):
+                if isinstance(tool_result_text, BaseException):
+                    tool_result_text = f"Tool execution error: {str(tool_result_text)}"
+                print(f"\n    ✓ {node['tool']} → {tool_result_text[:120]}...")
+                calls.append((node["tool"], node["args"]))
+                results.append(tool_result_text)
+        
+        messages.append(assistant_message("", calls))
+        for (tool_name, tool_args), tool_result_text in zip(calls, results):
+            if is_failed_result(tool_result_text):
+                failures.append(tool_name)
+            if not is_retryable_error(tool_result_text):
+                seen[self._call_key(tool_name, tool_args)] = tool_result_text
+            tool_log.append((len(messages), tool_name))
+            messages.append({"role": "tool", "content": tool_result_text})
+        compact_tool_history(messages, tool_log)
+        return True
+    
+    async def _speculate(self, messages: list, n_pending: int) -> tuple[str, list, list, list]:
+        """Decodes the next LLM turn early, with placeholders for results still in flight."""
+        placeholders = [
+            {"role": "tool", "content": f"<pending:{uuid.uuid4().hex[:8]}>"}
+            for _ in range(n_pending)
+        ]
+        # dispatch=False: nothing is sent to MCP until the guess is accepted
+        return await self._chat_and_dispatch(None, [*messages, *placeholders], dispatch=False)
+    
+    async def _check_speculation(self, speculation: asyncio.Task, prepared: list):
+        """
+        Returns the speculative response if it is safe to use, otherwise None.
+        
+        It is accepted only if it asks for MORE leaf lookups that are not a
+        repeat of the calls we just ran - i.e. the missing results could not
+        have changed it. A final answer is always thrown away, because it was
+        written without seeing the latest results.
+        """
+        try:
+            response = await speculation
+        except Exception as e:
+            log.debug("  Speculative decode failed: %s", e)
+            return None
+        
+        spec_prepared = response[2]
+        just_ran = {tool_call_key(name, args) for name, args in prepared}
+        usable = spec_prepared and all(
+            name in SPECULATIVE_SAFE_TOOLS and tool_call_key(name, args) not in just_ran
+            for name, args in spec_prepared
+        )
+        if not usable:
+            print("  ↺ Speculative LLM response discarded, asking again with real results")
+            return None
+        return response
+    
+    def _start_tool(self, session: ClientSession, tool_name: str, tool_args: dict,
+                    seen: dict | None = None) -> asyncio.Future:
+        """
+        Starts one tool call in the background and returns its task.
+        
+        A call already in `seen` (nothing to gain from running it again) is not sent:
+        the returned future is already done, with result None - the agent
+        loop answers it from `seen`.
+        """
+        if seen is not None and self._call_key(tool_name, tool_args) in seen:
+            print(f"\n    ↺ Tool: {tool_name} (already called - not sent again)")
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(None)
+            return done
+        print(f"\n    🔧 Tool: {tool_name}")
+        # Only formatted when LOG_LEVEL=DEBUG
+        log.debug("       Args: %r", tool_args)
+        invoke = self.invokers.get(tool_name)
+        if invoke is None:
+            invoke = functools.partial(invoke_unknown_tool, tool_name=tool_name)
+        elif tool_name == "check_ip_reputation" and self._not_in_reputation_index(tool_args):
+            invoke = functools.partial(invoke_clean_reputation, clean_verdict=self.clean_verdict)
+        return asyncio.create_task(invoke(session, tool_args))
+    
+    def _not_in_reputation_index(self, tool_args: dict) -> bool:
+        """True if the reputation index says this (valid, external) IP is definitely not listed."""
+        if self.reputation_index is None:
+            return False
+        ip = tool_args.get("ip_address")
+        if not isinstance(ip, str) or is_internal_ip(ip):
+            return False  # the usual path answers these
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            return False  # let the server report the bad address
+        return ip not in self.reputation_index
+    
+    async def _chat_and_dispatch(self, session: ClientSession, messages: list,
+                                 dispatch: bool = True, tools=None,
+                                 seen: dict | None = None) -> tuple[str, list, list, list]:
+        """
+        Streams one LLM response and starts each tool call the moment it arrives.
+        
+        Returns (content, tool_calls, prepared, pending):
+          content    - the text the LLM wrote
+          tool_calls - the raw tool calls, in the order the LLM made them
+          prepared   - (tool_name, tool_args) for each tool call
+          pending    - a running asyncio.Task per tool call, same order
+                       (empty when dispatch=False)
+        
+        If the Ollama server only sends tool calls at the very end of the
+        stream, this simply behaves like a normal (non-streaming) call.
+        Token counts and timing are logged at DEBUG level.
+        
+        tools overrides the tools offered to the LLM (default: all of them).
+        Calls already in `seen` are not dispatched again (see _start_tool).
+        """
+        prepared, pending = [], []
+        
+        def on_tool_call(tc):
+            tool_name = tc.function.name
+            tool_args = normalize_tool_args(tc.function.arguments)
+            prepared.append((tool_name, tool_args))
+            if dispatch:
+                pending.append(self._start_tool(session, tool_name, tool_args, seen))
+        
+        try:
+            stream = await self.client.chat(
+                model=MODEL,
+                messages=messages,
+                # The LLM sees these as options (tools=() offers none)
+                tools=self.ollama_tools if tools is None else tools,
+                stream=True,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                options={"num_ctx": OLLAMA_NUM_CTX}
+            )
+            response = await accumulate_streaming_response(stream, on_tool_call)
+        except BaseException:
+            # Don't leave orphaned tool calls running if the stream fails
+            for task in pending:
+                task.cancel()
+            raise
+        
+        log.debug("LLM: %s prompt tokens, %s generated tokens, %.1fs",
+                  response.prompt_eval_count, response.eval_count,
+                  (response.total_duration or 0) / 1e9)
+        
+        return response.message.content, response.message.tool_calls or [], prepared, pending
 
-Start by calling get_recent_alerts to see current alerts. Then for each external IP address found, call check_ip_reputation and lookup_ip_geolocation to gather threat intelligence.
 
-Private IP ranges (10.x.x.x, 192.168.x.x, 172.16-31.x.x) are internal and generally less suspicious than external IPs.
+async def run_soc_agent(user_query: str, pool: MCPSessionPool | None = None) -> str:
+    """
+    One-shot helper: start an agent, analyze a single query, shut it down.
+    
+    Pass an already-open MCPSessionPool to skip the MCP connection setup.
+    """
+    async with SocAgent(pool) as agent:
+        return await agent.analyze(user_query)
 
-Only after you have gathered all the data using tools, write your final threat assessment with:
-- Summary of findings
-- Risk level (LOW/MEDIUM/HIGH/CRITICAL) for each alert
-- Recommended actions (BLOCK, MONITOR, or INVESTIGATE)
 
-Always reference actual alert IDs and IP addresses in your analysis."""
-                
-                # messages is our conversation history
-                # We start with the system prompt + the user's question
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user",   "content": user_query}
-                ]
-                
-                # Create the Ollama client pointing to our local Ollama instance
-                ollama_client = ollama.Client(host=OLLAMA_URL)
-                
-                print(f"  ✓ Agent initialized with {len(ollama_tools)} tools available")
-                print(f"\n  USER QUERY: {user_query}")
-                
-                # -------------------------------------------------------
-                # STEP 4: THE AGENT LOOP
-                # -------------------------------------------------------
-                # This is the core of how agents work:
-                # 
-                #   LLM decides action
-                #       ↓
-                #   If "use a tool" → run tool → add result to conversation
-                #       ↓                              ↓
-                #   Loop back ←────────────────────────┘
-                #       ↓
-                #   If "I have enough info" → write final answer → DONE
-                #
-                # -------------------------------------------------------
-                print_section("STEP 4: Agent Loop Running")
-                
-                iteration = 0  # Safety counter
-                
-                while iteration < MAX_ITERATIONS:
-                    iteration += 1
-                    print(f"\n  [Iteration {iteration}/{MAX_ITERATIONS}] Querying LLM...")
-                    
-                    # ── Ask the LLM what to do next ──────────────────────
-                    # We send the full conversation history + available tools
-                    # The LLM will either:
-                    #   A) Call one or more tools (it needs more info)
-                    #   B) Write a final text answer (it's done)
-                    # ─────────────────────────────────────────────────────
-                    response = ollama_client.chat(
-                        model=MODEL,
-                        messages=messages,
-                        tools=ollama_tools  # The LLM sees these as options
-                    )
-                    
-                    llm_message = response.message
-                    
-                    # Add the LLM's response to our conversation history
-                    # (We need to track the full conversation so the LLM
-                    #  has context on what it's already done)
-                    messages.append({
-                        "role": "assistant",
-                        "content": llm_message.content or "",
-                        # tool_calls will be None if the LLM isn't calling tools
-                        "tool_calls": [
-                            {
-                                "function": {
-                                    "name": tc.function.name,
-                                    "arguments": tc.function.arguments
-                                }
-                            }
-                            for tc in (llm_message.tool_calls or [])
-                        ]
-                    })
-                    
-                    # ── Check: is the LLM done? ───────────────────────────
-                    # If there are no tool_calls, the LLM has written its
-                    # final analysis. We're done!
-                    # ─────────────────────────────────────────────────────
-                    if not llm_message.tool_calls:
-                        print("  ✓ LLM has reached a conclusion (no more tool calls)")
-                        print_section("FINAL THREAT ASSESSMENT", llm_message.content)
-                        return llm_message.content
-                    
-                    # ── Execute tool calls ────────────────────────────────
-                    # The LLM wants to call tools. Let's do that through MCP.
-                    # ─────────────────────────────────────────────────────
-                    print(f"  LLM is calling {len(llm_message.tool_calls)} tool(s):")
-                    
-                    for tool_call in llm_message.tool_calls:
-                        tool_name = tool_call.function.name
-                        tool_args = tool_call.function.arguments
-                        
-                        # tool_args might come back as a string or dict depending
-                        # on the Ollama version - normalize to dict
-                        if isinstance(tool_args, str):
-                            try:
-                                tool_args = json.loads(tool_args)
-                            except json.JSONDecodeError:
-                                tool_args = {}
-                        
-                        print(f"\n    🔧 Tool: {tool_name}")
-                        print(f"       Args: {json.dumps(tool_args, indent=8)}")
-                        
-                        # ── Call the tool through MCP ─────────────────────
-                        # session.call_tool() sends the request to our
-                        # MCP server and waits for the result
-                        # ─────────────────────────────────────────────────
-                        try:
-                            mcp_result = await session.call_tool(tool_name, tool_args)
-                            
-                            # Extract the text content from the MCP response
-                            # MCP returns a list of content blocks - we want text
-                            if mcp_result.content and len(mcp_result.content) > 0:
-                                tool_result_text = mcp_result.content[0].text
-                            else:
-                                tool_result_text = "Tool returned no content"
-                            
-                            print(f"       Result: {tool_result_text[:120]}...")
-                            
-                        except Exception as e:
-                            tool_result_text = f"Tool execution error: {str(e)}"
-                            print(f"       ERROR: {tool_result_text}")
-                        
-                        # ── Feed tool result back to LLM ──────────────────
-                        # This is crucial - we add the tool result to the
-                        # conversation so the LLM can use the information
-                        # ─────────────────────────────────────────────────
-                        messages.append({
-                            "role": "tool",
-                            "content": tool_result_text
-                        })
-                
-                # If we hit MAX_ITERATIONS, something went wrong
-                print_section("WARNING: Maximum iterations reached without conclusion")
-                return "Agent reached maximum iterations without completing analysis."
-    
-    except ConnectionRefusedError:
-        print(f"\n  ✗ ERROR: Could not connect to MCP server at {MCP_SERVER_URL}")
-        print("    Is the mcp-server container running? Try: docker compose ps")
-        sys.exit(1)
-    except Exception as e:
-        print(f"\n  ✗ ERROR: {str(e)}")
-        raise
+async def run_soc_agent_batch(queries: list[str], max_concurrency: int = 4,
+                              on_progress=None, pool: MCPSessionPool | None = None) -> list[str]:
+    """
+    Analyzes many queries with ONE agent (one connection, one tool discovery).
+    
+    Up to `max_concurrency` queries run at the same time, so their LLM calls
+    and tool calls overlap. Results come back in the same order as `queries`.
+    
+    on_progress, if given, is called as on_progress(done, total, query,
+    assessment) each time a query finishes (in completion order).
+    
+    Each running query borrows its own session from the agent's pool (up to
+    MCP_POOL_SIZE). Note that the progress output of concurrent queries will
+    be interleaved in the terminal.
+    """
+    async with SocAgent(pool) as agent:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        done = 0
+        
+        async def analyze_one(query: str) -> str:
+            nonlocal done
+            async with semaphore:
+                assessment = await agent.analyze(query)
+            done += 1
+            if on_progress is not None:
+                on_progress(done, len(queries), query, assessment)
+            return assessment
+        
+        return list(await asyncio.gather(*(analyze_one(q) for q in queries)))
 
 
 # -------------------------------------------------------
@@ -369,4 +1712,13 @@ if __name__ == "__main__":
         "IP addresses. I need a threat assessment report with your recommended actions."
     )
     
-    asyncio.run(run_soc_agent(query))
+    # Only the agent's own logger follows LOG_LEVEL; libraries (httpx etc.)
+    # stay at WARNING so their request logs don't flood the output
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    log.setLevel(LOG_LEVEL)
+    
+    async def main():
+        async with SocAgent() as agent:
+            await agent.analyze(query)
+    
+    asyncio.run(main())
@@ -19,8 +19,7 @@
 
 import asyncio
 import json
-from mcp import ClientSession
-from mcp.client.sse import sse_client
+from agent import MCPSessionPool
 
 MCP_SERVER_URL = "http://mcp-server:8000/sse"
 
@@ -33,9 +32,10 @@ async def test_all_tools():
     print("  Connecting to:", MCP_SERVER_URL)
     print("="*60)
     
-    async with sse_client(MCP_SERVER_URL) as (read, write):
-        async with ClientSession(read, write) as session:
-            await session.initialize()
+    # The same session pool the agent uses - it connects and does the
+    # MCP handshake (session.initialize()) for us
+    async with MCPSessionPool(MCP_SERVER_URL, size=1) as pool:
+        async with pool.session() as session:
             
             # ─── List all available tools ────────────────────────────
             tools = await session.list_tools()
@@ -87,6 +87,17 @@ async def test_all_tools():
             data = json.loads(result.content[0].text)
             print(json.dumps(data, indent=2))
             
+            # ─── Test: lookup_ip_geolocation_batch ───────────────────
+            print("\n" + "="*60)
+            print("  TEST: lookup_ip_geolocation_batch")
+            print("="*60)
+            result = await session.call_tool(
+                "lookup_ip_geolocation_batch", 
+                {"ip_addresses": ["185.220.101.45", "45.33.32.156", "10.0.0.52"]}
+            )
+            data = json.loads(result.content[0].text)
+            print(json.dumps(data, indent=2))
+            
             # ─── Test: get_alert_details ─────────────────────────────
             print("\n" + "="*60)
             print("  TEST: get_alert_details(alert_id='ALT-001')")
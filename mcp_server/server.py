@@ -21,11 +21,31 @@
 =============================================================
 """
 
+import asyncio
+import functools
+import ipaddress
 import json
+import time
 import httpx
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
 from mcp.server.fastmcp import FastMCP
 
+# Tool responses are COMPACT JSON (no indentation): the only reader is
+# the agent, and every space is bytes on the wire and a token for the
+# LLM. (test_tools.py pretty-prints them for humans.)
+#
+# orjson builds JSON several times faster than the standard library.
+# It is optional - without it we fall back to the json module.
+try:
+    import orjson
+    
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
 # -------------------------------------------------------
 # Create the MCP server instance
 # "SOC Tools Server" is just a human-readable name
@@ -50,6 +70,25 @@ KNOWN_MALICIOUS_IPS = {
     "89.248.167.131": {"threat": "Malware Distribution","confidence": 95},
 }
 
+# What check_ip_reputation says about an IP that is NOT in the feed
+# (plus "ip" and "checked_at", added per call).
+_CLEAN_VERDICT = {
+    "is_malicious": False,
+    "threat_type": "None detected",
+    "confidence_score": 0,
+    "recommendation": "MONITOR - No known threat indicators",
+}
+
+# The whole feed as one JSON list, for get_reputation_index(). The agent
+# downloads it once and can then tell locally that an IP is NOT listed,
+# skipping the check_ip_reputation round-trip. The clean verdict comes
+# along so the agent's local answer always matches ours. (A real feed
+# with millions of entries would ship a compact Bloom filter instead.)
+_REPUTATION_INDEX_JSON = _dumps({
+    "malicious_ips": sorted(KNOWN_MALICIOUS_IPS),
+    "clean_verdict": _CLEAN_VERDICT,
+})
+
 # -------------------------------------------------------
 # SIMULATED ALERT LOG
 # -------------------------------------------------------
@@ -105,6 +144,163 @@ SIMULATED_ALERTS = [
     },
 ]
 
+# The alerts never change while the server runs, so every answer the
+# alert tools can give is built ONCE here instead of on every call:
+#   _ALERTS_BY_ID       - alert ID → alert (no looping through the list)
+#   _ALERTS_BY_ID_JSON  - alert ID → the JSON get_alert_details returns
+#   _RECENT_ALERTS_JSON - limit (1-10) → the JSON get_recent_alerts returns
+_ALERTS_BY_ID = {alert["id"]: alert for alert in SIMULATED_ALERTS}
+_ALERTS_BY_ID_JSON = {
+    alert_id: _dumps(alert) for alert_id, alert in _ALERTS_BY_ID.items()
+}
+
+
+def _render_recent_alerts(limit: int) -> str:
+    alerts_to_return = SIMULATED_ALERTS[:limit]
+    
+    # We return JSON strings - structured data the agent can parse
+    return _dumps({
+        "alert_count": len(alerts_to_return),
+        "alerts": alerts_to_return
+    })
+
+
+_RECENT_ALERTS_JSON = {limit: _render_recent_alerts(limit) for limit in range(1, 11)}
+
+
+# -------------------------------------------------------
+# RESULT CACHES
+# -------------------------------------------------------
+# The agent often asks about the same IP more than once (the same
+# attacker shows up in several alerts). Geolocation is an internet
+# round-trip to ip-api.com (and rate limited!), so we remember each
+# answer for GEO_CACHE_TTL seconds.
+#
+# The cache holds at most GEO_CACHE_SIZE IPs: when full, the least
+# recently used one is dropped, so a long-running server doesn't
+# keep growing with every IP it has ever seen.
+#
+# Format: "ip": (time it was cached, JSON string we returned)
+# -------------------------------------------------------
+GEO_CACHE_TTL = 3600
+GEO_CACHE_SIZE = 4096
+_GEO_CACHE: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+# -------------------------------------------------------
+# SHARED HTTP CLIENT
+# -------------------------------------------------------
+# Creating a new HTTP client per lookup means a new TCP
+# connection (and handshake) every time. One shared client
+# keeps connections open and reuses them across calls.
+# It is created on first use, inside the server's event loop.
+# -------------------------------------------------------
+_HTTP: httpx.AsyncClient | None = None
+
+
+def _http_client() -> httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=20)
+        )
+    return _HTTP
+
+
+# -------------------------------------------------------
+# INTERNAL / INVALID IP CHECK
+# -------------------------------------------------------
+# There is no point looking up a private address (10.x, 192.168.x,
+# 172.16-31.x), loopback, link-local or multicast IP: ip-api.com just
+# answers "fail" and no threat feed lists them. The agent is TOLD this,
+# but LLMs still ask - so both IP tools answer these straight away.
+#
+# The agent answers internal IPs itself with the SAME definition and
+# the SAME response (agent.py: is_internal_ip / internal_ip_result) -
+# keep the two in step.
+# -------------------------------------------------------
+def _skip_ip_lookup(ip_address: str) -> str | None:
+    """Returns a ready answer for an invalid or internal IP, or None to look it up."""
+    try:
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return _dumps({"ip": ip_address, "error": "invalid ip"})
+    
+    if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_multicast:
+        return _dumps({
+            "ip": ip_address,
+            "is_private": True,
+            "recommendation": "IGNORE - internal"
+        })
+    return None
+
+
+# -------------------------------------------------------
+# IP-API.COM RATE LIMITING
+# -------------------------------------------------------
+# The free tier of ip-api.com allows 45 requests per minute.
+# Go over that and it answers HTTP 429 (and eventually bans
+# the IP for a while) - so when the agent fires lots of
+# geolocation lookups in parallel, we hold them back here:
+#
+#   _GEO_LIMITER - at most GEO_RATE_LIMIT requests in any
+#                  GEO_RATE_PERIOD seconds (one under the cap)
+#   _GEO_SEM     - at most GEO_CONCURRENCY requests in flight
+#
+# A request waits for the limiter FIRST and only then takes a
+# semaphore slot - so the slots are held by requests actually
+# talking to ip-api.com, never by ones sleeping out the minute.
+# Cache hits never get this far, so they cost nothing.
+# -------------------------------------------------------
+GEO_CONCURRENCY = 10
+GEO_RATE_LIMIT = 44
+GEO_RATE_PERIOD = 60.0
+
+# The batch endpoint (up to GEO_BATCH_SIZE IPs per request) has its
+# own, smaller cap: 15 requests per minute - and its own semaphore, so
+# batches never queue behind single lookups (or the other way round).
+GEO_BATCH_SIZE = 100
+GEO_BATCH_RATE_LIMIT = 14
+GEO_BATCH_CONCURRENCY = 2
+
+# The fields we ask ip-api.com for
+GEO_FIELDS = "status,country,regionName,city,isp,org,as,query"
+
+
+class SlidingWindowLimiter:
+    """
+    Allows at most `limit` calls in ANY `period`-second window.
+    
+    Remembers when each of the last `limit` calls started; acquire()
+    sleeps until the oldest of them is `period` seconds old. Unlike a
+    token bucket there is no burst allowance on top, so a busy minute
+    can never go over the provider's per-minute cap. Waiters are served
+    in order.
+    """
+    
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._calls: deque[float] = deque()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.limit:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self._calls[0] + self.period - now)
+
+
+_GEO_SEM = asyncio.Semaphore(GEO_CONCURRENCY)
+_GEO_LIMITER = SlidingWindowLimiter(GEO_RATE_LIMIT, GEO_RATE_PERIOD)
+_GEO_BATCH_SEM = asyncio.Semaphore(GEO_BATCH_CONCURRENCY)
+_GEO_BATCH_LIMITER = SlidingWindowLimiter(GEO_BATCH_RATE_LIMIT, GEO_RATE_PERIOD)
+
 
 # ===================================================
 # TOOL DEFINITIONS
@@ -130,13 +326,10 @@ async def get_recent_alerts(limit: int = 5) -> str:
     # Cap the limit so we don't return too much data
     limit = min(limit, 10)
     
-    alerts_to_return = SIMULATED_ALERTS[:limit]
-    
-    # We return JSON strings - structured data the agent can parse
-    return json.dumps({
-        "alert_count": len(alerts_to_return),
-        "alerts": alerts_to_return
-    }, indent=2)
+    rendered = _RECENT_ALERTS_JSON.get(limit)
+    if rendered is None:  # limit of 0 or less - not worth pre-building
+        rendered = _render_recent_alerts(limit)
+    return rendered
 
 
 @mcp.tool()
@@ -153,37 +346,128 @@ async def lookup_ip_geolocation(ip_address: str) -> str:
     Returns:
         Country, city, ISP, and organization details for the IP.
     """
+    # Internal or not an IP at all? Nothing to look up.
+    skipped = _skip_ip_lookup(ip_address)
+    if skipped is not None:
+        return skipped
+    
+    # Answered recently? Skip the HTTP call entirely.
+    cached = _geo_cached(ip_address)
+    if cached is not None:
+        return cached
+    
     # ip-api.com is a free service - no API key needed for the lab
-    # Rate limit: 45 requests/minute on the free tier
+    # Rate limit: 45 requests/minute on the free tier (see _GEO_LIMITER)
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(
+        await _GEO_LIMITER.acquire()
+        async with _GEO_SEM:
+            response = await _http_client().get(
                 f"http://ip-api.com/json/{ip_address}",
-                params={"fields": "status,country,regionName,city,isp,org,as,query"}
+                params={"fields": GEO_FIELDS}
             )
-            data = response.json()
-        
-        # ip-api.com returns "fail" status for private/reserved IPs
-        if data.get("status") == "fail":
-            return json.dumps({
-                "ip": ip_address,
-                "error": "Could not geolocate IP - may be private/reserved range",
-                "is_private": True
-            }, indent=2)
-        
-        return json.dumps({
-            "ip": ip_address,
-            "country": data.get("country", "Unknown"),
-            "region": data.get("regionName", "Unknown"),
-            "city": data.get("city", "Unknown"),
-            "isp": data.get("isp", "Unknown"),
-            "organization": data.get("org", "Unknown"),
-            "asn": data.get("as", "Unknown"),
-            "queried_at": datetime.now(timezone.utc).isoformat()
-        }, indent=2)
+        response.raise_for_status()  # e.g. 429 when over the rate limit
+        data = response.json()
     
     except Exception as e:
-        return json.dumps({"error": f"Geolocation lookup failed: {str(e)}"}, indent=2)
+        # Failures are NOT cached - the next call should try again
+        return _dumps({"error": f"Geolocation lookup failed: {str(e)}"})
+    
+    return _store_geolocation(ip_address, data)
+
+
+@mcp.tool()
+async def lookup_ip_geolocation_batch(ip_addresses: list[str]) -> str:
+    """
+    Look up geographic and network ownership information for SEVERAL IP addresses at once.
+    Use this instead of lookup_ip_geolocation whenever you have more than one IP to look up -
+    it answers them all in a single request.
+    
+    Args:
+        ip_addresses: The IPv4 addresses to look up (e.g., ['185.220.101.45', '45.33.32.156'])
+    
+    Returns:
+        A list with country, city, ISP, and organization details for each IP.
+    """
+    # Each unique IP once, in the order asked
+    ip_addresses = list(dict.fromkeys(ip_addresses))
+    answers = {}
+    to_fetch = []
+    for ip_address in ip_addresses:
+        answer = _skip_ip_lookup(ip_address) or _geo_cached(ip_address)
+        if answer is not None:
+            answers[ip_address] = answer
+        else:
+            to_fetch.append(ip_address)
+    
+    # ip-api.com takes up to GEO_BATCH_SIZE IPs per batch request
+    for start in range(0, len(to_fetch), GEO_BATCH_SIZE):
+        chunk = to_fetch[start:start + GEO_BATCH_SIZE]
+        try:
+            await _GEO_BATCH_LIMITER.acquire()
+            async with _GEO_BATCH_SEM:
+                response = await _http_client().post(
+                    "http://ip-api.com/batch",
+                    json=[{"query": ip_address, "fields": GEO_FIELDS} for ip_address in chunk]
+                )
+            response.raise_for_status()
+            results = response.json()
+            # Answers come back in the order the IPs were sent
+            for ip_address, data in zip(chunk, results, strict=True):
+                answers[ip_address] = _store_geolocation(ip_address, data)
+        except Exception as e:
+            # Failures are NOT cached - the next call should try again
+            for ip_address in chunk:
+                answers[ip_address] = _dumps({
+                    "ip": ip_address,
+                    "error": f"Geolocation lookup failed: {str(e)}"
+                })
+    
+    # Every answer is already a finished JSON object (the same text the
+    # single-IP tool returns and the cache holds), so the list is stitched
+    # together from those strings instead of decoding and re-encoding them.
+    results = ",".join(answers[ip_address] for ip_address in ip_addresses)
+    return f'{{"ip_count":{len(ip_addresses)},"results":[{results}]}}'
+
+
+def _geo_cached(ip_address: str) -> str | None:
+    """The cached geolocation answer for an IP, or None if missing or expired."""
+    cached = _GEO_CACHE.get(ip_address)
+    if cached is None:
+        return None
+    if time.time() - cached[0] >= GEO_CACHE_TTL:
+        del _GEO_CACHE[ip_address]  # expired - forget it
+        return None
+    _GEO_CACHE.move_to_end(ip_address)
+    return cached[1]
+
+
+def _store_geolocation(ip_address: str, data: dict) -> str:
+    """Turns one ip-api.com answer into our JSON response, caching successes."""
+    # ip-api.com returns "fail" status for private/reserved IPs - and for
+    # anything else it could not answer, so only "success" is remembered
+    if data.get("status") != "success":
+        return _dumps({
+            "ip": ip_address,
+            "error": "Could not geolocate IP - may be private/reserved range",
+            "is_private": True
+        })
+    
+    result = _dumps({
+        "ip": ip_address,
+        "country": data.get("country", "Unknown"),
+        "region": data.get("regionName", "Unknown"),
+        "city": data.get("city", "Unknown"),
+        "isp": data.get("isp", "Unknown"),
+        "organization": data.get("org", "Unknown"),
+        "asn": data.get("as", "Unknown"),
+        "queried_at": datetime.now(timezone.utc).isoformat()
+    })
+    
+    _GEO_CACHE[ip_address] = (time.time(), result)
+    _GEO_CACHE.move_to_end(ip_address)
+    if len(_GEO_CACHE) > GEO_CACHE_SIZE:
+        _GEO_CACHE.popitem(last=False)
+    return result
 
 
 @mcp.tool()
@@ -199,26 +483,49 @@ async def check_ip_reputation(ip_address: str) -> str:
     Returns:
         Threat status including is_malicious flag, threat type, and confidence score (0-100).
     """
+    skipped = _skip_ip_lookup(ip_address)
+    if skipped is not None:
+        return skipped
+    return _render_reputation(ip_address)
+
+
+# KNOWN_MALICIOUS_IPS never changes while the server runs, so the answer
+# for an IP never changes either - build each JSON response once and reuse
+# it. (checked_at then shows when the IP was FIRST checked, which is fine
+# for a static lab feed.)
+@functools.lru_cache(maxsize=4096)
+def _render_reputation(ip_address: str) -> str:
     if ip_address in KNOWN_MALICIOUS_IPS:
         threat_info = KNOWN_MALICIOUS_IPS[ip_address]
-        return json.dumps({
+        return _dumps({
             "ip": ip_address,
             "is_malicious": True,
             "threat_type": threat_info["threat"],
             "confidence_score": threat_info["confidence"],
             "recommendation": "BLOCK - High confidence threat indicator",
             "checked_at": datetime.now(timezone.utc).isoformat()
-        }, indent=2)
+        })
     
     # IP not in our threat list - treat as clean (for lab purposes)
-    return json.dumps({
+    return _dumps({
         "ip": ip_address,
-        "is_malicious": False,
-        "threat_type": "None detected",
-        "confidence_score": 0,
-        "recommendation": "MONITOR - No known threat indicators",
+        **_CLEAN_VERDICT,
         "checked_at": datetime.now(timezone.utc).isoformat()
-    }, indent=2)
+    })
+
+
+@mcp.tool()
+async def get_reputation_index() -> str:
+    """
+    Return every IP address listed in the threat intelligence feed.
+    Used by the agent itself to skip reputation checks for IPs that are not listed.
+    During an investigation, call check_ip_reputation instead.
+    
+    Returns:
+        A JSON object with a malicious_ips list and the clean_verdict
+        check_ip_reputation gives for any IP not on that list.
+    """
+    return _REPUTATION_INDEX_JSON
 
 
 @mcp.tool()
@@ -233,11 +540,10 @@ async def get_alert_details(alert_id: str) -> str:
     Returns:
         Full details of the specified alert.
     """
-    for alert in SIMULATED_ALERTS:
-        if alert["id"] == alert_id:
-            return json.dumps(alert, indent=2)
-    
-    return json.dumps({"error": f"Alert {alert_id} not found"}, indent=2)
+    rendered = _ALERTS_BY_ID_JSON.get(alert_id)
+    if rendered is None:
+        return _dumps({"error": f"Alert {alert_id} not found"})
+    return rendered
 
 
 # -------------------------------------------------------
@@ -251,5 +557,6 @@ async def get_alert_details(alert_id: str) -> str:
 if __name__ == "__main__":
     print("Starting SOC Tools MCP Server on port 8000...")
     print("Available tools: get_recent_alerts, lookup_ip_geolocation,")
-    print("                 check_ip_reputation, get_alert_details")
+    print("                 lookup_ip_geolocation_batch, check_ip_reputation,")
+    print("                 get_alert_details, get_reputation_index")
     mcp.run(transport="sse")